@@ -5,17 +5,24 @@
 #
 # HDF5 structure:
 # - tokens
-#    - token_1
-#        - 0 -> [13 * 768] matrix
-#        - 1 -> [13 * 768] matrix
-#    - token_2
-#        - 0 -> [13 * 768] matrix
-#        - 1 -> [13 * 768] matrix
-#        - 2 -> [13 * 768] matrix
-#        - 3 -> [13 * 768] matrix
+#    - token_1 -> [2 * 13 * 768] matrix
+#    - token_2 -> [4 * 13 * 768] matrix
+# - contexts
+#    - token_1 -> [2] sentence indices
+#    - token_2 -> [4] sentence indices
+# - sentences -> [S] sentences
 #
 # In the above case, `token_1` occurs 2 times in the dataset, and `token_2` occurs
-# 4 times. We have 13 layers from BERT and 768 dimensions from each layer
+# 4 times. We have 13 layers from BERT and 768 dimensions from each layer. The
+# i-th entry in `contexts` is the index in `sentences` of the sentence of the
+# i-th occurrence of the token. Each of the S input sentences is stored once.
+# With --decompose_layers, each token is a group with one [N * 768] matrix per
+# layer instead:
+# - tokens
+#    - token_1
+#        - 0 -> [2 * 768] matrix
+#        ...
+#        - 12 -> [2 * 768] matrix
 #
 # Author: Anonymized. Script was not written by the author of the paper
 # Last Modified: 2 March, 2020
@@ -35,23 +42,37 @@ import h5py
 
 from tqdm import tqdm
 from transformers import (
-    XLNetTokenizer,
+    AutoTokenizer,
     XLNetModel,
-    GPT2Tokenizer,
     GPT2Model,
-    XLMTokenizer,
-    XLMModel,
-    BertTokenizer,
     BertModel,
-    RobertaTokenizer,
     RobertaModel,
-    DistilBertTokenizer,
     DistilBertModel,
 )
 
 ## Globals
-tokenization_counts = {}
 MAX_SEQ_LEN = 512
+# Prefixes of the supported model names
+SUPPORTED_MODELS = ("xlnet", "gpt2", "bert", "distilbert", "roberta")
+# With a compiled model, sequences are padded to a multiple of this length so
+# that only a few input shapes (64, 128, ..., MAX_SEQ_LEN) need to be compiled
+SEQ_LEN_BUCKET = 64
+# Upper bound for the size of a single HDF5 chunk
+HDF5_CHUNK_BYTES = 1024 * 1024
+# Number of occurrences of a token per HDF5 chunk
+HDF5_OCCURRENCES_PER_CHUNK = 8
+# Number of sentence indices per HDF5 chunk. The indices are small and stored
+# without filters, so that frequent tokens do not end up with many tiny chunks
+HDF5_SENTENCE_INDICES_PER_CHUNK = 1024
+# Number of sentences after which buffered occurrences are written to HDF5
+HDF5_FLUSH_SENTENCES = 100
+# Filters for the activation datasets: LZF is fast and lossless, and the
+# shuffle filter groups bytes of the same significance so floats compress better
+HDF5_FILTERS = {"compression": "lzf", "shuffle": True}
+# Options for opening HDF5 output files: the latest file format has cheaper
+# metadata updates for growing datasets. The default chunk cache is kept, as
+# datasets are only opened for a single append per flush
+HDF5_FILE_OPTIONS = {"libver": "latest"}
 
 def get_model_and_tokenizer(
     model_name, device="cpu", random_weights=False, model_path=None
@@ -65,45 +86,50 @@ def get_model_and_tokenizer(
         print("Initializing model from local path:", model_path)
         init_model = model_path
 
+    # Fast tokenizers are required for the subword to word alignment, so models
+    # without one (e.g. XLM) are rejected before anything is loaded. Tokenizers
+    # that mark the start of a word with a space need to add it to the first
+    # word when tokenizing pre-split input
+    if not model_name.startswith(SUPPORTED_MODELS):
+        print("Unrecognized model name:", model_name)
+        sys.exit(1)
+    tokenizer = AutoTokenizer.from_pretrained(
+        init_model,
+        use_fast=True,
+        add_prefix_space=model_name.startswith(("gpt2", "roberta")),
+    )
+    if not tokenizer.is_fast:
+        print("No fast tokenizer available for model:", model_name)
+        sys.exit(1)
+    if model_name.startswith("gpt2"):
+        # GPT-2 has no padding token, which is required for batching
+        tokenizer.pad_token = tokenizer.eos_token
+
     if model_name.startswith("xlnet"):
         model = XLNetModel.from_pretrained(init_model, output_hidden_states=True).to(
             device
         )
-        tokenizer = XLNetTokenizer.from_pretrained(init_model)
         sep = u"▁"
     elif model_name.startswith("gpt2"):
         model = GPT2Model.from_pretrained(init_model, output_hidden_states=True).to(
             device
         )
-        tokenizer = GPT2Tokenizer.from_pretrained(init_model)
         sep = "Ġ"
-    elif model_name.startswith("xlm"):
-        model = XLMModel.from_pretrained(init_model, output_hidden_states=True).to(
-            device
-        )
-        tokenizer = XLMTokenizer.from_pretrained(init_model)
-        sep = "</w>"
     elif model_name.startswith("bert"):
         model = BertModel.from_pretrained(init_model, output_hidden_states=True).to(
             device
         )
-        tokenizer = BertTokenizer.from_pretrained(init_model)
         sep = "##"
     elif model_name.startswith("distilbert"):
         model = DistilBertModel.from_pretrained(
             init_model, output_hidden_states=True
         ).to(device)
-        tokenizer = DistilBertTokenizer.from_pretrained(init_model)
         sep = "##"
     elif model_name.startswith("roberta"):
-        model = RobertaModel.from_pretrained(model_name, output_hidden_states=True).to(
+        model = RobertaModel.from_pretrained(init_model, output_hidden_states=True).to(
             device
         )
-        tokenizer = RobertaTokenizer.from_pretrained(model_name)
         sep = "Ġ"
-    else:
-        print("Unrecognized model name:", model_name)
-        sys.exit()
 
     if random_weights:
         print("Randomizing weights")
@@ -113,39 +139,187 @@ def get_model_and_tokenizer(
 
 
 # aggregate_repr
-# Function that aggregates activations/embeddings over a span of subword tokens
+# Function that aggregates activations/embeddings over the spans of subword tokens
+# of all words in a batch at once, directly from the output of each layer
 #
 # Parameters:
-#  state: Matrix of size [ NUM_LAYERS x NUM_SUBWORD_TOKENS_IN_SENT x LAYER_DIM]
-#  start: index of the first subword of the word being processed
-#  end: index of the last subword of the word being processed
+#  hidden_states: NUM_LAYERS matrices of size [BATCH_SIZE x SEQ_LEN x LAYER_DIM]
+#  word_index: for each of the BATCH_SIZE * SEQ_LEN token positions, the index of
+#    the word it belongs to, numbering the words of the whole batch in order.
+#    Special and padding tokens belong to the extra word NUM_WORDS_IN_BATCH
+#  num_words: NUM_WORDS_IN_BATCH
 #  aggregation: aggregation method
 #
 # Returns:
-#  word_vector: Matrix of size [NUM_LAYERS x LAYER_DIM]
+#  word_vectors: float32 matrix of size [NUM_LAYERS x NUM_WORDS_IN_BATCH + 1 x LAYER_DIM],
+#    the last row collects the special and padding tokens and can be ignored
 #
-# This function will be called once per word. For example, if we had the sentence:
-#   "This is an example"
-# Tokenized by BPE:
-#   "this is an ex @@am @@ple"
+# For example, if we had the batch:
+#   "This is an example", "Hi"
+# Tokenized by BPE and padded:
+#   "[CLS] this is an ex @@am @@ple [SEP]", "[CLS] hi [SEP] [PAD] [PAD] [PAD] [PAD] [PAD]"
 #
-# The function will be called 4 times:
-#   aggregate_repr(state, 0, 0, aggregation)
-#   aggregate_repr(state, 1, 1, aggregation)
-#   aggregate_repr(state, 2, 2, aggregation)
-#   aggregate_repr(state, 3, 5, aggregation)
-def aggregate_repr(state, start, end, aggregation):
-    if aggregation == "first":
-        return state[:, start, :]
-    elif aggregation == "last":
-        return state[:, end, :]
-    elif aggregation == "average":
-        return np.average(state[:, start : end + 1, :], axis=1)
+# The function will be called once as:
+#   aggregate_repr(hidden_states, [5, 0, 1, 2, 3, 3, 3, 5, 5, 4, 5, 5, 5, 5, 5, 5], 5, aggregation)
+# and aggregates the subwords in place, without gathering them per sentence first.
+#
+# Words without any subwords (e.g. because the input was truncated) get a zero
+# vector.
+def aggregate_repr(hidden_states, word_index, num_words, aggregation):
+    word_index = torch.as_tensor(word_index, dtype=torch.long)
+    counts = torch.bincount(word_index, minlength=num_words + 1)
+
+    num_layers, layer_dim = len(hidden_states), hidden_states[0].shape[-1]
+    # Words are accumulated in float32, also when the model runs under autocast
+    word_vectors = hidden_states[0].new_zeros(
+        (num_layers, num_words + 1, layer_dim), dtype=torch.float32
+    )
+
+    # Indices are computed on the host and copied without blocking, so that
+    # no device synchronization is needed
+    def to_device(indices):
+        return indices.to(word_vectors.device, non_blocking=True)
+
+    if aggregation == "average":
+        device_word_index = to_device(word_index)
+        for layer, layer_states in enumerate(hidden_states):
+            word_vectors[layer].index_add_(
+                0, device_word_index, layer_states.reshape(-1, layer_dim).float()
+            )
+        word_vectors /= to_device(counts.clamp(min=1).float())[None, :, None]
+    elif aggregation in ("first", "last"):
+        # Subwords of a word are contiguous and words are numbered in order, so
+        # the token positions that belong to words are sorted by word
+        subword_positions = (word_index < num_words).nonzero(as_tuple=True)[0]
+        counts = counts[:num_words]
+        valid = counts > 0
+        if not valid.any():
+            return word_vectors
+        ends = torch.cumsum(counts, 0)
+        if aggregation == "first":
+            positions = subword_positions[(ends - counts)[valid]]
+        else:
+            positions = subword_positions[ends[valid] - 1]
+        words = to_device(valid.nonzero(as_tuple=True)[0])
+        positions = to_device(positions)
+        for layer, layer_states in enumerate(hidden_states):
+            word_vectors[layer, words, :] = (
+                layer_states.reshape(-1, layer_dim).index_select(0, positions).float()
+            )
+    return word_vectors
+
+
+def corpus_generator(input_corpus_path):
+    with open(input_corpus_path, "r") as fp:
+        for line in fp:
+            yield line.strip()
+        return
+
+
+def batch_generator(sentences, batch_size):
+    # Buffer sentences so that the model processes them in batches
+    batch = []
+    for sentence in sentences:
+        batch.append(sentence)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def tokenize_batch(sentences, tokenizer, pad_to_multiple_of=None):
+    """
+    Tokenize a batch of sentences, whose tokens are separated by spaces
+
+    Returns a dict with the sentences, the padded model inputs and for every
+    sentence the index of the original token each position belongs to (None
+    for special and padding tokens).
+    """
+    encoded = tokenizer(
+        [sentence.split(' ') for sentence in sentences],
+        is_split_into_words=True,
+        padding=True,
+        truncation=True,
+        max_length=MAX_SEQ_LEN,
+        pad_to_multiple_of=pad_to_multiple_of,
+        return_tensors="pt",
+    )
+    return {
+        "sentences": sentences,
+        "model_inputs": dict(encoded),
+        "word_ids": [encoded.word_ids(idx) for idx in range(len(sentences))],
+    }
+
+
+class CorpusDataset(torch.utils.data.IterableDataset):
+    """
+    Tokenized batches of a corpus with one sentence per line, so that
+    tokenization can run in DataLoader worker processes. With several
+    workers, worker i handles batches i, i + num_workers, ..., which the
+    DataLoader then returns in the order of the corpus.
+    """
+
+    def __init__(self, input_corpus_path, tokenizer, batch_size, pad_to_multiple_of=None):
+        self.input_corpus_path = input_corpus_path
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        batches = batch_generator(corpus_generator(self.input_corpus_path), self.batch_size)
+        for batch_idx, batch in enumerate(batches):
+            if batch_idx % num_workers == worker_id:
+                yield tokenize_batch(batch, self.tokenizer, self.pad_to_multiple_of)
+
+
+class PinnedHostBuffer:
+    """
+    Page-locked host memory that word representations are copied into
+    asynchronously on a separate CUDA stream. Two buffers are used in turns, so
+    that the representations of one batch can be read while the copy of the
+    next batch is in flight.
+    """
+
+    def __init__(self):
+        self.buffers = [None, None]
+        self.current = 0
+        self.stream = torch.cuda.Stream()
+
+    def copy(self, tensor):
+        """
+        Start copying a device tensor to the host
+
+        Returns the host tensor and a CUDA event. The host tensor can only be
+        read once the event has completed and stays valid until the next
+        but one call to `copy`.
+        """
+        self.current = 1 - self.current
+        buffer = self.buffers[self.current]
+        if buffer is None or buffer.dtype != tensor.dtype or buffer.numel() < tensor.numel():
+            buffer = torch.empty(tensor.numel(), dtype=tensor.dtype, pin_memory=True)
+            self.buffers[self.current] = buffer
+        host_tensor = buffer[: tensor.numel()].view(tensor.shape)
+
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            host_tensor.copy_(tensor, non_blocking=True)
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+        # Keep the device memory from being reused before the copy is done
+        tensor.record_stream(self.stream)
+
+        return host_tensor, copy_done
 
 
 # this follows the HuggingFace API for pytorch-transformers
-def get_sentence_repr(
-    sentence,
+def get_batch_repr(
+    batch,
     model,
     tokenizer,
     sep,
@@ -154,97 +328,166 @@ def get_sentence_repr(
     device="cpu",
     include_embeddings=False,
     aggregation="last",
-    filter_words=["[CLS]", "[PAD]", "[SEP]"],
+    verbose=False,
+    host_buffer=None,
+    dtype="float32",
+    output_dtype="float32",
 ):
     """
-    Get representations for one sentence
-    """
+    Get representations for a batch of sentences using a single forward pass
 
-    special_tokens = [x for x in tokenizer.all_special_tokens if x != tokenizer.unk_token]
-    special_tokens_ids = tokenizer.convert_tokens_to_ids(special_tokens)
+    batch: tokenized batch as returned by tokenize_batch
+    host_buffer: if given, a PinnedHostBuffer the representations are copied
+        into without blocking
+    dtype: with float16 on CUDA, the forward pass runs under autocast
+    output_dtype: dtype of the returned representations
 
-    original_tokens = sentence.split(' ')
-    # Add spaces before each word since some tokenizers are space sensitive
-    original_tokens = ['a' + ' ' + x if x_idx != 0 else x for x_idx, x in enumerate(original_tokens)]
+    Returns the list of (hidden_states, extracted_words) for each sentence, and
+    a CUDA event that has to be synchronized on before reading the hidden
+    states, or None if they can be read right away.
+    """
+
+    model_inputs = batch["model_inputs"]
+    use_autocast = torch.device(device).type == "cuda" and dtype == "float16"
+
+    # Map every token position of the batch to the word it belongs to. Special
+    # and padding tokens have no word id, which also takes care of padding
+    # being on either side depending on the tokenizer
+    batch_repr = []
+    word_index = []
+    num_words = 0
+    for sentence_idx, sentence in enumerate(batch["sentences"]):
+        if model_inputs["attention_mask"][sentence_idx].sum() >= MAX_SEQ_LEN:
+            print("[WARNING] Input truncated because of length")
+        word_ids = batch["word_ids"][sentence_idx]
+        subword_positions = [idx for idx, word_id in enumerate(word_ids) if word_id is not None]
+        extracted_words = get_sentence_repr(
+            sentence,
+            model_inputs["input_ids"][sentence_idx][subword_positions].tolist(),
+            [word_ids[idx] for idx in subword_positions],
+            tokenizer,
+            verbose=verbose,
+        )
+        batch_repr.append((num_words, extracted_words))
+        word_index.append([
+            num_words + word_id if word_id is not None else -1 for word_id in word_ids
+        ])
+        num_words += len(extracted_words)
+    word_index = torch.tensor(word_index, dtype=torch.long).view(-1)
+    word_index[word_index < 0] = num_words
 
     with torch.no_grad():
-        # Get tokenization counts if not already available
-        for token_idx, token in enumerate(original_tokens):
-            tok_ids = [x for x in tokenizer.encode(token) if x not in special_tokens_ids]
-            # print(tokenizer.convert_ids_to_tokens(tok_ids))
-            if token_idx != 0:
-                tok_ids = tok_ids[1:]
-                # print(tokenizer.convert_ids_to_tokens(tok_ids))
-            # print('------------')
-            if token in tokenization_counts:
-                assert(tokenization_counts[token] == len(tok_ids))
-            else:
-                tokenization_counts[token] = len(tok_ids)
-        ids = tokenizer.encode(sentence, truncation=True, max_length=MAX_SEQ_LEN)
-        input_ids = torch.tensor([ids]).to(device)
-        # Hugging Face format: list of torch.FloatTensor of shape (batch_size, sequence_length, hidden_size) (hidden_states at output of each layer plus initial embedding outputs)
-        all_hidden_states = model(input_ids)[-1]
-        # convert to format required for contexteval: numpy array of shape (num_layers, sequence_length, representation_dim)
-        if include_embeddings:
-            all_hidden_states = [
-                hidden_states[0].cpu().numpy() for hidden_states in all_hidden_states
-            ]
+        # Hugging Face format: tuple of torch.FloatTensor of shape (batch_size, sequence_length, hidden_size) (hidden_states at output of each layer plus initial embedding outputs)
+        # reduced to the words of the batch layer by layer, kept on the device
+        with torch.cuda.amp.autocast(enabled=use_autocast):
+            all_hidden_states = model(
+                **{k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+            ).hidden_states
+        if not include_embeddings:
+            all_hidden_states = all_hidden_states[:-1]
+
+        # Words are aggregated in float32 and only the result is converted, in
+        # a single copy to the host for the whole batch
+        word_vectors = aggregate_repr(
+            all_hidden_states, word_index, num_words, aggregation
+        ).to(getattr(torch, output_dtype))
+        if host_buffer is not None:
+            word_vectors, copy_done = host_buffer.copy(word_vectors)
         else:
-            all_hidden_states = [
-                hidden_states[0].cpu().numpy()
-                for hidden_states in all_hidden_states[:-1]
-            ]
-        all_hidden_states = np.array(all_hidden_states)
-
-    print("Sentence          : \"%s\"" % (sentence))
-    print("Original    (%03d): %s" % (len(original_tokens), original_tokens))
-    print("Tokenized   (%03d): %s" % (len(tokenizer.convert_ids_to_tokens(ids)), tokenizer.convert_ids_to_tokens(ids)))
-    
-    ids_without_special_tokens = [x for x in ids if x not in special_tokens_ids]
-    segmented_tokens = tokenizer.convert_ids_to_tokens(ids_without_special_tokens)
+            word_vectors, copy_done = word_vectors.cpu(), None
+
+    word_vectors = word_vectors.numpy()
+    for sentence_idx, (word_offset, extracted_words) in enumerate(batch_repr):
+        batch_repr[sentence_idx] = (
+            word_vectors[:, word_offset : word_offset + len(extracted_words), :],
+            extracted_words,
+        )
+
+    return batch_repr, copy_done
+
+
+def get_sentence_repr(
+    sentence,
+    ids,
+    word_ids,
+    tokenizer,
+    verbose=False,
+):
+    """
+    Get the detokenized words of one sentence
+
+    ids: subword ids of the sentence as fed to the model, without special tokens
+    word_ids: index of the original token each subword belongs to
+
+    Returns the subwords of each original token joined together. The
+    representations themselves are aggregated for the whole batch at once.
+    """
+
+    original_tokens = sentence.split(' ')
+
+    if verbose:
+        print("Sentence          : \"%s\"" % (sentence))
+        print("Original    (%03d): %s" % (len(original_tokens), original_tokens))
+
+    segmented_tokens = tokenizer.convert_ids_to_tokens(ids)
+    if verbose:
+        print("Tokenized   (%03d): %s" % (len(segmented_tokens), segmented_tokens))
+
+    # Subwords of a word are contiguous, so counting them gives the spans
+    counts = [0] * len(original_tokens)
+    for word_id in word_ids:
+        counts[word_id] += 1
 
-    counter = 0
     detokenized = []
-    final_hidden_states = np.zeros((all_hidden_states.shape[0], len(original_tokens), all_hidden_states.shape[2]))
-
-    for token_idx, token in enumerate(original_tokens):
-        current_word_start_idx = counter
-        current_word_end_idx = counter + tokenization_counts[token]
-        final_hidden_states[:, len(detokenized), :] = aggregate_repr(
-                        all_hidden_states,
-                        current_word_start_idx,
-                        current_word_end_idx,
-                        aggregation,
-                    )
-        detokenized.append("".join(segmented_tokens[current_word_start_idx:current_word_end_idx]))
-        
-        counter += tokenization_counts[token]
+    counter = 0
+    for count in counts:
+        detokenized.append("".join(segmented_tokens[counter:counter + count]))
+        counter += count
 
-    print("Detokenized (%03d): %s" % (len(detokenized), detokenized))
-    print("Counter: %d" % (counter))
-    
-    if len(ids) >= 512:
-        print("[WARNING] Input truncated because of length, skipping check")
-    else:
-        assert(counter == len(ids_without_special_tokens))
-        assert(len(detokenized) == len(original_tokens))
-    print("===================================================================")
+    if verbose:
+        print("Detokenized (%03d): %s" % (len(detokenized), detokenized))
+        print("Counter: %d" % (counter))
+        print("===================================================================")
+
+    return detokenized
+
+def get_hdf5_chunks(shape, dtype):
+    """
+    Chunk shape for an HDF5 dataset: the whole dataset if it fits into
+    HDF5_CHUNK_BYTES, so that reading it is a single chunk read. Larger
+    datasets are split along their largest dimension until a chunk fits.
+    Empty datasets are stored contiguously (None), since a chunk must not be
+    larger than the dataset.
+    """
+    if 0 in shape:
+        return None
+    chunks = list(shape)
+    while np.prod(chunks) * np.dtype(dtype).itemsize > HDF5_CHUNK_BYTES:
+        largest_dim = int(np.argmax(chunks))
+        chunks[largest_dim] = (chunks[largest_dim] + 1) // 2
+    return tuple(chunks)
 
-    return final_hidden_states, detokenized
 
 # from https://github.com/nelson-liu/contextual-repr-analysis
-def make_hdf5_file(sentence_to_index, vectors, output_file_path):
-    with h5py.File(output_file_path, "w") as fout:
+def make_hdf5_file(sentence_to_index, vectors, output_file_path, dtype="float16"):
+    with h5py.File(output_file_path, "w", **HDF5_FILE_OPTIONS) as fout:
         for key, embeddings in vectors.items():
+            chunks = get_hdf5_chunks(embeddings.shape, dtype)
+            # Filters need a chunked dataset
             fout.create_dataset(
-                str(key), embeddings.shape, dtype="float32", data=embeddings
+                str(key),
+                embeddings.shape,
+                dtype=dtype,
+                data=embeddings,
+                chunks=chunks,
+                **(HDF5_FILTERS if chunks is not None else {}),
             )
         sentence_index_dataset = fout.create_dataset(
             "sentence_to_index", (1,), dtype=h5py.special_dtype(vlen=str)
         )
         sentence_index_dataset[0] = json.dumps(sentence_to_index)
 
-def extract_representations(model_name, input_corpus, output_file, device="cpu", aggregation="last", output_type="json", filter_vocab=None, model_path=None, limit_max_occurrences=-1, random_weights=False, ignore_embeddings=False):
+def extract_representations(model_name, input_corpus, output_file, device="cpu", aggregation="last", output_type="json", filter_vocab=None, model_path=None, limit_max_occurrences=-1, random_weights=False, ignore_embeddings=False, batch_size=32, verbose=False, dtype="float16", decompose_layers=False, num_workers=4, compile_model=False):
     print("Loading model")
     model, tokenizer, sep = get_model_and_tokenizer(
         model_name,
@@ -253,13 +496,117 @@ def extract_representations(model_name, input_corpus, output_file, device="cpu",
         model_path=model_path,
     )
 
+    pad_to_multiple_of = None
+    if compile_model:
+        if hasattr(torch, "compile"):
+            print("Compiling model")
+            # Captures CUDA graphs for the fixed, bucketed input shapes
+            model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+            pad_to_multiple_of = SEQ_LEN_BUCKET
+        else:
+            print("[WARNING] torch.compile is not available in this torch version, running the model in eager mode")
+
     print("Reading input corpus")
+    # Tokenization runs in the loader workers, overlapping with the model
+    loader_options = {}
+    if num_workers > 0:
+        loader_options["prefetch_factor"] = 4
+    corpus_loader = torch.utils.data.DataLoader(
+        CorpusDataset(input_corpus, tokenizer, batch_size, pad_to_multiple_of=pad_to_multiple_of),
+        batch_size=None,
+        num_workers=num_workers,
+        pin_memory=(torch.device(device).type == "cuda"),
+        **loader_options,
+    )
 
-    def corpus_generator(input_corpus_path):
-        with open(input_corpus_path, "r") as fp:
-            for line in fp:
-                yield line.strip()
-            return
+    def representation_generator(batches):
+        # The next batch is queued on the device before the representations of
+        # the previous one are read, so that computing and writing overlap
+        pending = None
+        for batch in batches:
+            current = (batch["sentences"],) + get_batch_repr(
+                batch,
+                model,
+                tokenizer,
+                sep,
+                model_name,
+                filter_vocab,
+                device=device,
+                include_embeddings=(not ignore_embeddings),
+                aggregation=aggregation,
+                verbose=verbose,
+                host_buffer=host_buffer,
+                dtype=dtype,
+                output_dtype=output_dtype,
+            )
+            if pending is not None:
+                yield from read_batch_repr(*pending)
+            pending = current
+        if pending is not None:
+            yield from read_batch_repr(*pending)
+
+    def read_batch_repr(sentences, batch_repr, copy_done):
+        if copy_done is not None:
+            copy_done.synchronize()
+        return zip(sentences, batch_repr)
+
+    host_buffer = None
+    if torch.device(device).type == "cuda":
+        host_buffer = PinnedHostBuffer()
+
+    # dtype only applies to the HDF5 datasets, JSON output keeps full precision
+    output_dtype = dtype if output_type == "hdf5" else "float32"
+
+    def create_occurrence_dataset(hdf5_path, shape):
+        return output_file.create_dataset(
+            hdf5_path,
+            (0,) + shape,
+            maxshape=(None,) + shape,
+            dtype=dtype,
+            chunks=(HDF5_OCCURRENCES_PER_CHUNK,) + shape,
+            **HDF5_FILTERS,
+        )
+
+    def append_occurrences(dset, values):
+        if not isinstance(dset, h5py.Dataset):
+            raise TypeError("Expected an HDF5 dataset at %s" % (dset.name))
+        num_occurrences = dset.shape[0]
+        dset.resize(num_occurrences + len(values), axis=0)
+        dset[num_occurrences:] = values
+
+    def flush_occurrences():
+        for extracted_word, occurrences in buffered_occurrences.items():
+            hdf5_path = "tokens/%s" % (extracted_word)
+            vectors = np.stack([vector for vector, _ in occurrences])
+            num_layers, layer_dim = vectors.shape[1:]
+            if hdf5_path not in output_file:
+                if decompose_layers:
+                    for layer_idx in range(num_layers):
+                        create_occurrence_dataset(hdf5_path + "/%d" % (layer_idx), (layer_dim,))
+                else:
+                    create_occurrence_dataset(hdf5_path, (num_layers, layer_dim))
+                output_file.create_dataset(
+                    "contexts/%s" % (extracted_word),
+                    (0,),
+                    maxshape=(None,),
+                    dtype=np.int64,
+                    chunks=(HDF5_SENTENCE_INDICES_PER_CHUNK,),
+                )
+
+            if decompose_layers:
+                for layer_idx in range(num_layers):
+                    append_occurrences(
+                        output_file[hdf5_path + "/%d" % (layer_idx)], vectors[:, layer_idx, :]
+                    )
+            else:
+                append_occurrences(output_file[hdf5_path], vectors)
+            append_occurrences(
+                output_file["contexts/%s" % (extracted_word)],
+                [sentence_idx for _, sentence_idx in occurrences],
+            )
+        buffered_occurrences.clear()
+        append_occurrences(output_file["sentences"], buffered_sentences)
+        buffered_sentences.clear()
 
     print("Reading filter vocabulary")
     filter_vocab = None
@@ -277,8 +624,23 @@ def extract_representations(model_name, input_corpus, output_file, device="cpu",
                 "[WARNING] Output filename (%s) does not end with .hdf5, but output file type is hdf5."
                 % (output_file)
             )
-        output_file = h5py.File(output_file, "w")
+        output_file = h5py.File(output_file, "w", **HDF5_FILE_OPTIONS)
         output_file.create_group("tokens")
+        output_file.create_group("contexts")
+        output_file.create_dataset(
+            "sentences",
+            (0,),
+            maxshape=(None,),
+            dtype=h5py.special_dtype(vlen=str),
+        )
+        # Occurrences are buffered per token and appended to the token's
+        # datasets in one go, instead of creating a dataset per occurrence
+        buffered_occurrences = collections.defaultdict(list)
+        # Number of occurrences saved per token, so that the file does not
+        # need to be queried for it
+        occurrence_counts = collections.defaultdict(int)
+        # Sentences are stored once and referenced by their index
+        buffered_sentences = []
     elif output_type == "json":
         if not output_file.endswith(".json"):
             print(
@@ -288,64 +650,57 @@ def extract_representations(model_name, input_corpus, output_file, device="cpu",
         output_file = open(output_file, "w", encoding="utf-8")
 
     print("Extracting representations from model")
-    for sentence_idx, sentence in enumerate(corpus_generator(input_corpus)):
-        hidden_states, extracted_words = get_sentence_repr(
-            sentence,
-            model,
-            tokenizer,
-            sep,
-            model_name,
-            filter_vocab,
-            device=device,
-            include_embeddings=(not ignore_embeddings),
-            aggregation=aggregation,
-        )
-
-        print("Hidden states: ", hidden_states.shape)
-        print("# Extracted words: ", len(extracted_words))
+    for sentence_idx, (sentence, (hidden_states, extracted_words)) in enumerate(
+        representation_generator(corpus_loader)
+    ):
+        if verbose:
+            print("Hidden states: ", hidden_states.shape)
+            print("# Extracted words: ", len(extracted_words))
 
         if output_type == "hdf5":
+            buffered_sentences.append(sentence)
+            # Words without subwords (empty tokens, or cut off by truncation)
+            # only have a zero vector, which is not saved as an occurrence
+            num_empty_words = extracted_words.count("")
+            if num_empty_words > 0:
+                print(
+                    "[WARNING] Skipping %d word(s) without subwords in sentence %d"
+                    % (num_empty_words, sentence_idx)
+                )
             for idx, extracted_word in enumerate(extracted_words):
-                if extracted_word in HDF5_SPECIAL_TOKENS:
-                    extracted_word = HDF5_SPECIAL_TOKENS[extracted_word]
-                hdf5_path = "tokens/%s" % (extracted_word)
-                if hdf5_path not in output_file:
-                    word_idx = 0
-                else:
-                    word_idx = len(output_file[hdf5_path].keys())
-                hdf5_path = "tokens/%s/%d" % (extracted_word, word_idx)
-                print("hdf5 path:", hdf5_path)
+                if extracted_word == "":
+                    continue
+                extracted_word = get_hdf5_name(extracted_word)
+                word_idx = occurrence_counts[extracted_word]
+                if verbose:
+                    print("hdf5 path: tokens/%s [%d]" % (extracted_word, word_idx))
 
                 if limit_max_occurrences >= 0 and word_idx >= limit_max_occurrences:
-                    print("Skipping because of occurrence limit")
+                    if verbose:
+                        print("Skipping because of occurrence limit")
                     continue
 
-                assert hdf5_path not in output_file
-                if decompose_layers:
-                    for layer_idx in range(13):
-                        dset = output_file.create_dataset(
-                            hdf5_path + "/%d" % (layer_idx), (768,), dtype="f"
-                        )
-                        dset[...] = hidden_states[layer_idx, idx, :]
-                    output_file[hdf5_path].attrs["context"] = sentence
-                else:
-                    dset = output_file.create_dataset(hdf5_path, (13, 768), dtype="f")
-                    dset[...] = hidden_states[:, idx, :]
-                    dset.attrs["context"] = sentence
+                occurrence_counts[extracted_word] += 1
+
+                # The hidden states are only valid until the next batch is read
+                buffered_occurrences[extracted_word].append(
+                    (hidden_states[:, idx, :].copy(), sentence_idx)
+                )
+            if (sentence_idx + 1) % HDF5_FLUSH_SENTENCES == 0:
+                flush_occurrences()
         elif output_type == "json":
             output_json = collections.OrderedDict()
             output_json["linex_index"] = sentence_idx
             all_out_features = []
 
+            # Round and convert all values at once instead of value by value
+            rounded_values = np.round(hidden_states.astype(np.float64), 8).tolist()
             for word_idx, extracted_word in enumerate(extracted_words):
                 all_layers = []
                 for layer_idx in range(hidden_states.shape[0]):
                     layers = collections.OrderedDict()
                     layers["index"] = layer_idx
-                    layers["values"] = [
-                        round(x.item(), 8)
-                        for x in hidden_states[layer_idx, word_idx, :]
-                    ]
+                    layers["values"] = rounded_values[layer_idx][word_idx]
                     all_layers.append(layers)
                 out_features = collections.OrderedDict()
                 out_features["token"] = extracted_word
@@ -354,14 +709,27 @@ def extract_representations(model_name, input_corpus, output_file, device="cpu",
             output_json["features"] = all_out_features
             output_file.write(json.dumps(output_json) + "\n")
 
+    if output_type == "hdf5":
+        flush_occurrences()
     output_file.close()
 
 
 HDF5_SPECIAL_TOKENS = {
+    "": "__EMPTY__",
     ".": "__DOT__",
     "/": "__SLASH__"
 }
 
+def get_hdf5_name(word):
+    """
+    Name of the HDF5 datasets of a token: "/" separates HDF5 path components
+    and is escaped anywhere in the token, and "" and "." get names of their own.
+    Empty tokens are not saved, their name only guards against invalid paths
+    """
+    if word in HDF5_SPECIAL_TOKENS:
+        return HDF5_SPECIAL_TOKENS[word]
+    return word.replace("/", HDF5_SPECIAL_TOKENS["/"])
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("model_name", help="Name of model")
@@ -397,6 +765,29 @@ def main():
         default="json",
         help="Output format of the extracted representations",
     )
+    parser.add_argument(
+        "--batch_size",
+        help="Number of sentences passed through the model at once",
+        default=32,
+        type=int
+    )
+    parser.add_argument(
+        "--num_workers",
+        help="Number of worker processes that read and tokenize the input corpus, 0 to do it in the main process",
+        default=4,
+        type=int
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=["float16", "float32"],
+        default="float16",
+        help="Dtype of the HDF5 datasets, float16 also runs the model under autocast on GPU. JSON output is always float32",
+    )
+    parser.add_argument(
+        "--compile_model",
+        action="store_true",
+        help="compile the model with torch.compile, padding inputs to a few fixed lengths (requires torch>=2.0)",
+    )
     parser.add_argument("--decompose_layers", action="store_true")
     parser.add_argument("--disable_cuda", action="store_true")
     parser.add_argument("--ignore_embeddings", action="store_true")
@@ -405,6 +796,11 @@ def main():
         action="store_true",
         help="generate representations from randomly initialized model",
     )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print tokenization details for every sentence",
+    )
     args = parser.parse_args()
 
     assert args.aggregation in [
@@ -426,7 +822,13 @@ def main():
         model_path=args.model_path,
         limit_max_occurrences=args.limit_max_occurrences,
         random_weights=args.random_weights,
-        ignore_embeddings=args.ignore_embeddings)
+        ignore_embeddings=args.ignore_embeddings,
+        batch_size=args.batch_size,
+        verbose=args.verbose,
+        dtype=args.dtype,
+        decompose_layers=args.decompose_layers,
+        num_workers=args.num_workers,
+        compile_model=args.compile_model)
     
 
 if __name__ == "__main__":